@@ -1,111 +1,224 @@
 import numpy as np
-from typing import List
-from collections import defaultdict 
+from numba import njit, prange
 
 
-class CC:
+# the kernels are compiled eagerly (explicit signatures) when the module is
+# imported and cached on disk, so parallel workers load machine code instead
+# of paying the JIT cost on their first call
+@njit('UniTuple(i8, 2)(i8[::1], i8[::1], b1[::1], u8[:, ::1], i4[::1], i8[::1], i8[::1], i4[::1], i8, i8, i8[::1], i8)',
+      cache=True)
+def apply_step(recs, searching, searching_mask, G, best_cc_id, num_followers, follow_counts, found_best_at, max_follows, t, changed, n_searching):
     '''
-    Class modelling the behavior of con∏tent creators.
+    Applies the follow decisions of one timestep for all searching users
+    in a single compiled loop; recs[i] is the recommendation for user
+    searching[i]. Each user follows their recommended CC iff it improves
+    on their best so far (and the follow cap is not reached), and users
+    recommended CC 0 are marked as done searching by clearing their bit
+    in searching_mask. A negative max_follows means unlimited follows,
+    in which case follow_counts is an unused empty array.
+    The ids of CCs that gained a follower are written into changed;
+    returns how many entries were written along with the updated number
+    of searching users.
     '''
-    def __init__(self, id):
-        self.id = id
+    n_changed = 0
+    for i in range(searching.size):
+        u = searching[i]
+        c = recs[i]
+        if c < best_cc_id[u] and (max_follows < 0 or follow_counts[u] <= max_follows):
+            G[u, c >> 6] |= np.uint64(1) << np.uint64(c & 63)
+            best_cc_id[u] = c
+            num_followers[c] += 1
+            if max_follows >= 0:
+                follow_counts[u] += 1
+            changed[n_changed] = c
+            n_changed += 1
+        if c == 0:
+            found_best_at[u] = t
+            searching_mask[u] = False
+            n_searching -= 1
+    return n_changed, n_searching
 
 
-class User:
+@njit('void(f8[:, ::1], f8[::1])', cache=True, parallel=True, fastmath=True)
+def average_probs(log_weights, out):
     '''
-    Class modelling the behavior of users.
+    Fills out with the recommendation probabilities, i.e. the average over
+    all alphas of the softmax of the cached alpha*log(num_followers + 1)
+    weights. Working in log space with the max-shift trick keeps
+    exp(alpha*log(nf+1)) from overflowing for large alphas, which
+    (nf+1)**alpha computed directly would.
     '''
-    def __init__(self, id):
-        self.id = id
+    A, C = log_weights.shape
+    for i in prange(C):
+        out[i] = 0.0
+    for a in range(A):
+        m = log_weights[a, 0]
+        for i in range(C):
+            if log_weights[a, i] > m:
+                m = log_weights[a, i]
+        Z = 0.0
+        for i in prange(C):
+            Z += np.exp(log_weights[a, i] - m)
+        for i in prange(C):
+            out[i] += np.exp(log_weights[a, i] - m) / Z / A
 
-        # the best CC followed so far
-        self.best_followed_CC = None
 
-    def decide_follow(self, c: CC):
-        '''Evaluates whether the user wants to follow CC c.
-
-        input: c - a content creator
-        ------
-        output: bool - decision if it follows c'''
+@njit('Tuple((f8[::1], i8[::1]))(f8[::1])', cache=True)
+def build_alias(p):
+    '''
+    Builds the alias table (Walker/Vose method) for the categorical
+    distribution p in O(len(p)), so that each sample afterwards costs O(1)
+    instead of the O(log len(p)) binary search of inverse-CDF sampling.
+    '''
+    n = p.size
+    prob = np.empty(n)
+    alias = np.zeros(n, dtype=np.int64)
+    scaled = p * n
+    small = np.empty(n, dtype=np.int64)
+    large = np.empty(n, dtype=np.int64)
+    ns = 0
+    nl = 0
+    for i in range(n):
+        if scaled[i] < 1.0:
+            small[ns] = i
+            ns += 1
+        else:
+            large[nl] = i
+            nl += 1
+    while ns > 0 and nl > 0:
+        ns -= 1
+        nl -= 1
+        s = small[ns]
+        l = large[nl]
+        prob[s] = scaled[s]
+        alias[s] = l
+        scaled[l] -= 1.0 - scaled[s]
+        if scaled[l] < 1.0:
+            small[ns] = l
+            ns += 1
+        else:
+            large[nl] = l
+            nl += 1
+    # leftovers are 1.0 up to floating point error
+    while nl > 0:
+        nl -= 1
+        prob[large[nl]] = 1.0
+    while ns > 0:
+        ns -= 1
+        prob[small[ns]] = 1.0
+    return prob, alias
 
-        # it follows c iff they are better (closer to top) then the best followed so far
-        if (self.best_followed_CC is None) or (self.best_followed_CC.id > c.id):
-            return True
 
-        return False
+@njit('void(f8[::1], i8[::1], f8[::1], f8[::1], i8[::1])', cache=True)
+def sample_alias(prob, alias, u1, u2, out):
+    '''
+    Draws out.size categorical samples from the alias table (prob, alias)
+    using two uniforms per sample: u2 picks the bin, u1 decides between the
+    bin and its alias.
+    '''
+    n = prob.size
+    for i in range(out.size):
+        j = int(u2[i] * n)
+        if j == n:
+            j = n - 1
+        out[i] = j if u1[i] < prob[j] else alias[j]
 
 
 class Network:
     '''
-    Class capturing a follower network between from users to items, stored as an adjacency matrix.
+    Class capturing a follower network from users to CCs, stored as a boolean
+    adjacency matrix together with per-node degree counts.
     '''
-    def __init__(self, u_ids: List[int], c_ids: List[int], max_follows: int = 0):
-        self.users = [User(u_id) for u_id in u_ids]
-        self.CCs = [CC(c_id) for c_id in c_ids]
+    def __init__(self, num_users: int, num_CCs: int, max_follows: int = 0):
         # keep track of the number of followers each CC has
-        self.num_followers = np.zeros(len(c_ids))
-        # keep track of the number of CCs each user follows
-        self.num_followees = np.zeros(len(u_ids))
-        # adjacency list of the graph
-        self.adjacency_list = [[] for _ in range(len(self.users))]
+        self.num_followers = np.zeros(num_CCs, dtype=np.int64)
+        # per-user follow counts are only maintained while a follow cap is
+        # enforced; num_followees is derived from the adjacency bits
+        self._cap_counts = np.zeros(num_users if max_follows else 0, dtype=np.int64)
+        # adjacency matrix of the graph, packed 64 CCs per uint64 word:
+        # bit (c & 63) of G[u, c >> 6] is set iff user u follows CC c
+        self.words_per_row = (num_CCs + 63) >> 6
+        self.G = np.zeros((num_users, self.words_per_row), dtype=np.uint64)
 
         self.max_follows = np.inf if not max_follows else max_follows
 
-    def follow(self, u_id: int, c_id: int):
+    @property
+    def num_followees(self):
         '''
-        User u follows content creator c; and updates the Network
-
-        input: u - user
-               c - CC
-               num_timestep - the iteration number of the platform (int)
-               when_users_found_best - a list of length the number of users who keeps the timesteps when each of the user found their best CC (or -1 if they didn't yet)
+        The number of CCs each user follows, computed from the row
+        popcounts of the packed adjacency matrix.
         '''
-        u = self.users[u_id]
-        c = self.CCs[c_id]
-        if not self.is_following(u, c):
-            if u.decide_follow(c) and self.num_followees[u.id] <= self.max_follows:
-                self.adjacency_list[u.id].append(c_id)
-                self.num_followers[c.id] += 1
-                self.num_followees[u.id] += 1
-                u.best_followed_CC = c
-
-    def is_following(self, u: User, c: CC) -> bool:
+        return np.bitwise_count(self.G).sum(axis=1, dtype=np.int64)
+
+    def is_following(self, u_id: int, c_id: int) -> bool:
         '''
         Returns True if user u follows content creator c.
         '''
-        return c.id in self.adjacency_list[u.id]
+        return bool((int(self.G[u_id, c_id >> 6]) >> int(c_id & 63)) & 1)
 
 
 class Platform:
     '''
     Class for simulating the recommendation procedure given the parameters
-    specified in __init__.
+    specified in __init__. All per-user and per-CC state is kept in flat
+    numpy arrays so that one timestep is a handful of vectorized operations.
     '''
-    def __init__(self, num_users: int, num_CCs: int, alphas: List[float], gen, evolution = 0, max_follows = 0):
+    def __init__(self, num_users: int, num_CCs: int, alphas, gen, evolution = 0, max_follows = 0, log_tables = None, num_steps = 0):
         # store params
         self.num_users = num_users
         self.num_CCs = num_CCs
-        self.alphas = alphas
+        self.alphas = np.asarray(alphas, dtype=np.float64)
         self.gen = gen
-        self.num_alphas = len(self.alphas)
-
-        # set up users, CCs and network classes
-        self.u_ids = list(range(num_users))
-        self.c_ids = list(range(num_CCs))
-        self.network = Network(self.u_ids, self.c_ids, max_follows)
-        
-        # keep track of the timesteps when users found their best CC
-        self.users_found_best = [-1]*num_users
+        self.num_alphas = self.alphas.size
+
+        # set up the network; keep direct references to its arrays so the
+        # per-step kernel call doesn't repeat the attribute-chain lookups
+        self.network = Network(num_users, num_CCs, max_follows)
+        self._G = self.network.G
+        self._num_followers = self.network.num_followers
+        self._cap_counts = self.network._cap_counts
+        # follow cap as a plain int for the compiled kernel (-1 means unlimited)
+        self._max_follows = max_follows if max_follows else -1
+
+        # the best (lowest-id) CC each user follows so far; "infinity" until the first follow
+        self.best_cc_id = np.full(num_users, np.iinfo(np.int32).max, dtype=np.int32)
+        # keep track of the timesteps when users found their best CC (-1 if they didn't yet)
+        self.found_best_at = np.full(num_users, -1, dtype=np.int32)
         # keep track of the average quality experienced by users
         self.average_pos_best_CC = []
-        # list containing the indices of users who have not not converged yet
-        self.id_searching_users = list(range(num_users))
+        # mask and running count of users who have not converged yet
+        self.searching_mask = np.ones(num_users, dtype=bool)
+        self._n_searching = num_users
         # the platform keeps track of the number of timesteps it has been iterated
         self.timestep = 0
 
-        # keep track of how the network evolves
+        # lookup tables of alpha*log(k + 1) for every possible follower count
+        # k in 0..num_users, so weight updates are gathers instead of
+        # transcendental evaluations; shareable across platforms with the
+        # same alphas and num_users
+        if log_tables is None:
+            log_tables = self.alphas[:, None] * np.log1p(np.arange(num_users + 1))
+        self._log_tables = log_tables
+        # cached per-alpha log weights alpha*log(num_followers + 1),
+        # patched incrementally as follower counts change
+        self._logpow = np.ascontiguousarray(self._log_tables[:, self._num_followers])
+        # scratch buffer for the ids of CCs that gained a follower in a step
+        self._changed = np.empty(num_users, dtype=np.int64)
+
+        # keep track of how the network evolves, one preallocated row per snapshot
         self.evolution = evolution
-        self.evolutionary_data = dict()
+        if evolution:
+            n_snap = num_steps // evolution if num_steps else 64
+        else:
+            n_snap = 0
+        self._snap_count = 0
+        self._snap_t = np.empty(n_snap, dtype=np.int32)
+        self._snap_probs = np.empty((n_snap, num_CCs))
+        self._snap_followers = np.empty((n_snap, num_CCs), dtype=np.int64)
+        self._snap_followees = np.empty((n_snap, num_users), dtype=np.int64)
+        self._snap_satisfactions = np.empty((n_snap, num_users), dtype=np.int32)
+        # the probability vector of the current timestep, stashed by recommend
+        self._probs = None
 
     def iterate(self) -> bool:
         '''
@@ -117,48 +230,80 @@ class Platform:
         # 0) the platform starts the next iteration
         self.timestep += 1
 
-        # 1) each user gets a recommendation
-        recs = self.recommend()
+        # 1) each still-searching user gets a recommendation
+        searching = np.flatnonzero(self.searching_mask)
+        recs = self.recommend(searching.size)
 
-        # 2) each user decides whether or not to follow the recommended CC
-        for u_id in self.id_searching_users: # only the users who have not found the best CC yet (CC_0)
-            c_id = recs[u_id]
-            self.network.follow(u_id, c_id)
-            if c_id == 0: # in this case we follow the best CC to the procedure is done for user u
-                self.users_found_best[u_id] = self.timestep
-            
-        self.update_searching_users()
+        # 2) each searching user follows the recommended CC iff it improves on their best so far
+        n_changed, self._n_searching = apply_step(
+            recs, searching, self.searching_mask, self._G,
+            self.best_cc_id, self._num_followers,
+            self._cap_counts, self.found_best_at,
+            self._max_follows, self.timestep, self._changed, self._n_searching)
+        self.update_probs(self._changed[:n_changed])
 
         if self.evolution and self.timestep % (self.evolution) == 0:
-            self.evolutionary_data[self.timestep]['num_followers'] = np.copy(self.network.num_followers)
-            self.evolutionary_data[self.timestep]['num_followees'] = np.copy(self.network.num_followees)
-            self.evolutionary_data[self.timestep]['user_satisfactions'] = [u.best_followed_CC.id for u in self.network.users]
+            k = self._snap_count
+            if k == self._snap_t.size:
+                self._grow_snapshots()
+            self._snap_t[k] = self.timestep
+            self._snap_probs[k] = self._probs
+            self._snap_followers[k] = self._num_followers
+            self._snap_followees[k] = self.network.num_followees
+            self._snap_satisfactions[k] = self.best_cc_id
+            self._snap_count = k + 1
 
         return self.check_convergence()
 
-    def update_searching_users(self):
+    def update_probs(self, c_changed):
         '''
-        Updates the list of users who are still searching for CC_0.
+        Patches the cached per-alpha log weights for the CCs whose follower
+        count just changed, instead of recomputing all num_CCs entries.
         '''
-        self.id_searching_users = list(filter(lambda i: self.users_found_best[i] == -1, self.id_searching_users))
+        if c_changed.size == 0:
+            return
+        c = np.unique(c_changed)
+        self._logpow[:, c] = self._log_tables[:, self._num_followers[c]]
 
-    def recommend(self) -> np.array:
+    def recommend(self, size: int = None) -> np.array:
         '''
-        input: content_creators - a list of content creators
-        num_followers - number of followers of each content creator
+        input: size - number of recommendations to draw (defaults to num_users)
         -----
-        output: array of CCs chosen based on PA
+        output: array of size CC ids chosen based on PA
         '''
-        probs = np.zeros(self.num_CCs)
-        for alpha in self.alphas:
-            prob_choice = np.power(self.network.num_followers + np.ones(self.num_CCs), alpha)
-            prob_choice /= sum(prob_choice)
-            probs += prob_choice / self.num_alphas
-            if self.evolution and self.timestep % (self.evolution) == 0:
-                self.evolutionary_data[self.timestep] = {'probs': probs}
+        if size is None:
+            size = self.num_users
+        probs = np.empty(self.num_CCs)
+        average_probs(self._logpow, probs)
+        self._probs = probs
+
+        prob, alias = build_alias(probs)
+        u1, u2 = self.gen.random((2, size))
+        recs = np.empty(size, dtype=np.int64)
+        sample_alias(prob, alias, u1, u2, recs)
+        return recs
 
-        return self.gen.choice(self.c_ids, self.num_users, p=probs)
+    def _grow_snapshots(self):
+        '''Doubles the snapshot capacity (only needed for unbounded runs).'''
+        self._snap_t = np.concatenate([self._snap_t, np.empty_like(self._snap_t)])
+        self._snap_probs = np.concatenate([self._snap_probs, np.empty_like(self._snap_probs)])
+        self._snap_followers = np.concatenate([self._snap_followers, np.empty_like(self._snap_followers)])
+        self._snap_followees = np.concatenate([self._snap_followees, np.empty_like(self._snap_followees)])
+        self._snap_satisfactions = np.concatenate([self._snap_satisfactions, np.empty_like(self._snap_satisfactions)])
+
+    @property
+    def evolutionary_data(self):
+        '''
+        Snapshots of the network state taken every `evolution` timesteps,
+        as a dict of arrays with one row per snapshot.
+        '''
+        k = self._snap_count
+        return {'timesteps': self._snap_t[:k],
+                'probs': self._snap_probs[:k],
+                'num_followers': self._snap_followers[:k],
+                'num_followees': self._snap_followees[:k],
+                'user_satisfactions': self._snap_satisfactions[:k]}
 
     def check_convergence(self) -> bool:
         # the platform converged if there are no more searching users (users who can find better CCs)
-        return len(self.id_searching_users) == 0
\ No newline at end of file
+        return self._n_searching == 0
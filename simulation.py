@@ -1,6 +1,7 @@
 import numpy as np
 import pandas as pd
 from typing import Dict
+from joblib import Parallel, delayed
 import model
 
 class Simulation:
@@ -18,8 +19,8 @@ class Simulation:
             num_steps: number of steps to run the simulation for; if num_steps == None, the simulation will run until convergence
             random_seed: random seed for the simulation
         '''
-        # set the random seed
-        self.gen = np.random.RandomState(random_seed)
+        # set the random seed; each replica derives its own generator from it
+        self.random_seed = random_seed
         self.num_CCs = num_CCs
         # store params
         self.num_users = num_users
@@ -31,48 +32,61 @@ class Simulation:
 
         self.results = []
 
+        # log-weight lookup tables shared by every replica (alphas and
+        # num_users are fixed across the batch)
+        self.log_tables = np.asarray(alphas, dtype=np.float64)[:, None] * np.log1p(np.arange(num_users + 1))
+
     def simulate(self) -> Dict[int, dict]:
         '''Runs a simulation, for the parameters in the config file.
-        
+
+        The replicas are independent, so they are fanned out across all
+        cores with joblib, each with its own derived seed.
+
         returns a dictionary with the results of the simulation
         such that dict[i] returns the result of the i'th simulation
         '''
-        
-        self.results = {}
-        for i in range(self.num_simulations):
-            # variables to track during simulation
-            data = {}
-            num_iterations = 0
-            # create the platform
-            p = model.Platform(self.num_users, self.num_CCs, self.alphas, self.gen, self.evolution, self.max_follows)
 
-            # iterate the platform either num_steps or until convergence
-            if self.num_steps:
-                did_converge = False
-                for _ in range(self.num_steps):
-                    # iterate only if it didn't converge so far
-                    if not did_converge:
-                        did_converge = p.iterate()
-                        num_iterations += 1
-                    else:
-                        break
-            else:
-                while not p.check_convergence():
-                    num_iterations += 1
-                    p.iterate()
+        seeds = np.random.SeedSequence(self.random_seed).spawn(self.num_simulations)
+        results = Parallel(n_jobs=-1, backend='loky')(
+            delayed(self._run_one)(seed) for seed in seeds)
+        self.results = dict(enumerate(results))
 
-            # record statistics after the runs
-            data['timesteps'] = num_iterations
-            data['num_followers'] = p.network.num_followers
-            data['num_followees'] = p.network.num_followees
-            data['num_timestep_users_found_best'] = p.users_found_best
-            data['average_pos_best_CC'] = p.average_pos_best_CC
-            data['did_converge'] = p.check_convergence()
-            data['user_satisfaction'] = [u.best_followed_CC.id for u in p.network.users]
-            if self.evolution:
-                data['evolutionary_data'] = p.evolutionary_data
+        return self.results
+
+    def _run_one(self, seed) -> dict:
+        '''Runs a single replica with its own random generator (PCG64, seeded
+        from a spawned SeedSequence) and returns its statistics.'''
+        gen = np.random.default_rng(seed)
+        # variables to track during simulation
+        data = {}
+        num_iterations = 0
+        # create the platform
+        p = model.Platform(self.num_users, self.num_CCs, self.alphas, gen, self.evolution,
+                           self.max_follows, self.log_tables, self.num_steps or 0)
+
+        # iterate the platform either num_steps or until convergence
+        if self.num_steps:
+            for step in range(self.num_steps):
+                if p.iterate():
+                    num_iterations = step + 1
+                    break
+            else:
+                num_iterations = self.num_steps
+        else:
+            while not p.check_convergence():
+                num_iterations += 1
+                p.iterate()
 
-            # data['G'] = p.network.G.tolist() #instead of hte whole network it woould be good to have aggregates here aoready.
-            self.results[i] = data
+        # record statistics after the runs
+        data['timesteps'] = num_iterations
+        data['num_followers'] = p.network.num_followers
+        data['num_followees'] = p.network.num_followees
+        data['num_timestep_users_found_best'] = p.found_best_at
+        data['average_pos_best_CC'] = p.average_pos_best_CC
+        data['did_converge'] = p.check_convergence()
+        data['user_satisfaction'] = p.best_cc_id
+        if self.evolution:
+            data['evolutionary_data'] = p.evolutionary_data
 
-        return self.results
\ No newline at end of file
+        # data['G'] = p.network.G.tolist() #instead of hte whole network it woould be good to have aggregates here aoready.
+        return data
\ No newline at end of file